@@ -1,10 +1,59 @@
 import re
 import requests
 import json
+import hashlib
+import io
 import os
 import argparse
+import functools
+import queue
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple, Iterable, Iterator
+
+# 行内公式/加粗文本；用于 split 时每个匹配依次产出 block/inline/bold 三个分组
+_INLINE_RE = re.compile(
+    r'(?P<block>\$\$(?:.*?\$\$)?)|\$(?P<inline>.*?)\$|\*\*(?P<bold>.*?)\*\*'
+)
+# 加粗片段模板，浅拷贝后只替换 text；annotations 在各片段间共享，不可修改
+_BOLD_PART_TEMPLATE = {"type": "text", "text": None, "annotations": {"bold": True}}
+# 图片: ![alt](path)
+_IMAGE_RE = re.compile(r'!\[(.*?)\]\((.*?)\)')
+
+# 标题前缀 -> 块类型，较长的前缀在前
+_HEADINGS = (("### ", "heading_3"), ("## ", "heading_2"), ("# ", "heading_1"))
+
+def _match_heading(line: str) -> Optional[Tuple[str, str]]:
+    """匹配标题行，返回 (块类型, 标题文本)，非标题返回None"""
+    for prefix, block_type in _HEADINGS:
+        if line.startswith(prefix):
+            return block_type, line[len(prefix):]
+    return None
+
+def _classify(line: str) -> Tuple[str, ...]:
+    """按首字符判断行类型，只有可能命中的行才做前缀/正则匹配
+
+    Returns:
+        ("heading", 块类型, 文本) / ("equation_fence",) /
+        ("image", alt文本, 图片路径) / ("paragraph", 行内容)
+    """
+    first = line[:1]
+    if first == "#":
+        heading = _match_heading(line)
+        if heading is not None:
+            return ("heading",) + heading
+    elif first == "$":
+        if line == "$$":
+            return ("equation_fence",)
+    elif first == "!":
+        match = _IMAGE_RE.match(line)
+        if match:
+            return ("image",) + match.groups()
+    return ("paragraph", line)
 
 def get_env_var(var_name: str) -> str:
     """获取环境变量值
@@ -23,7 +72,28 @@ def get_env_var(var_name: str) -> str:
         raise ValueError(f"环境变量 {var_name} 未设置或为空，请设置有效的值后重试")
     return var.strip()
 
+def create_session(pool_size: int = 16) -> requests.Session:
+    """创建复用连接的Session，并对限流(429)自动重试"""
+    # 追加子块不是幂等操作：只重试服务端确定未处理的429；
+    # 网关错误(502/504)时请求可能已生效，重试会重复创建整批块
+    retry = Retry(
+        total=3,
+        read=0,  # 请求已发出但读取失败时不重试，避免重复创建块
+        backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=frozenset({"PATCH", "POST"}),
+        raise_on_status=False,  # 重试用尽后返回最后的响应，交由调用方按 response.ok 处理
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
 class NotionClient:
+    # Notion 接口单次最多追加100个子块
+    MAX_BLOCKS_PER_REQUEST = 100
+
     def __init__(self, api_key: str, page_id: str):
         self.api_key = api_key
         self.page_id = page_id
@@ -32,30 +102,114 @@ class NotionClient:
             "Content-Type": "application/json",
             "Notion-Version": "2022-06-28"
         }
+        self.session = create_session()
+        self.session.headers.update(self.headers)
         
     def create_block(self, block_data: Dict[str, Any]) -> bool:
-        """创建Notion块"""
+        """创建单个Notion块"""
+        return self.create_blocks([block_data]) == 0
+
+    def create_blocks(self, blocks: List[Dict[str, Any]]) -> int:
+        """批量创建Notion块，每次请求最多提交 MAX_BLOCKS_PER_REQUEST 个
+
+        Returns:
+            创建失败的块数量，全部成功时为0
+        """
         url = f"https://api.notion.com/v1/blocks/{self.page_id}/children"
-        response = requests.patch(url, headers=self.headers, 
-                                data=json.dumps({"children": [block_data]}))
-        if not response.ok:
-            print(f"创建块失败: {response.text}")
-            return False
-        return True
+        failed = 0
+        # 追加子块按请求到达顺序生效，同一页面的批次必须串行发送，不能并发
+        for i in range(0, len(blocks), self.MAX_BLOCKS_PER_REQUEST):
+            failed += self._append_children(url, blocks[i:i + self.MAX_BLOCKS_PER_REQUEST])
+        return failed
+
+    def _append_children(self, url: str, chunk: List[Dict[str, Any]]) -> int:
+        """提交一批块，返回失败的块数量
+
+        Notion 只要有一个子块无效就会拒绝整个请求，收到4xx时将该批二分重试，
+        使最终只丢弃无效的块，其余块仍按原顺序创建。
+        """
+        response = self.session.patch(url, json={"children": chunk})
+        if response.ok:
+            return 0
+        if len(chunk) > 1 and 400 <= response.status_code < 500 and response.status_code != 429:
+            mid = len(chunk) // 2
+            return (self._append_children(url, chunk[:mid]) +
+                    self._append_children(url, chunk[mid:]))
+        print(f"创建块失败: {response.text}")
+        return len(chunk)
 
 class ImageUploader:
-    def __init__(self, api_key: str):
+    # imgbb 有频率限制，同时进行的上传数不超过该值
+    MAX_CONCURRENT_UPLOADS = 5
+
+    # 已上传图片的缓存: 文件内容sha256 -> imgbb URL
+    CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "md_to_notion", "imgbb.json")
+
+    def __init__(self, api_key: str, cache_path: Optional[str] = CACHE_PATH):
         self.api_key = api_key
+        self._upload_slots = threading.Semaphore(self.MAX_CONCURRENT_UPLOADS)
+        self.session = create_session()
+        self.cache_path = cache_path
+        self._cache_lock = threading.Lock()
+        self._url_cache = self._load_cache()
         
     def upload_to_imgbb(self, image_path: str) -> Optional[str]:
-        """上传图片到imgbb"""
+        """上传图片到imgbb，内容相同的图片直接复用缓存的URL，可在多线程中并发调用"""
+        # 只读一次文件，同一份数据用于计算哈希和上传
+        try:
+            with open(image_path, "rb") as f:
+                image_data = f.read()
+        except OSError as e:
+            print(f"图片读取出错: {str(e)}")
+            return None
+        digest = hashlib.sha256(image_data).hexdigest()
+
+        with self._cache_lock:
+            url = self._url_cache.get(digest)
+        if url:
+            return url
+
+        with self._upload_slots:
+            url = self._upload(image_path, image_data)
+        if url:
+            self._save_url(digest, url)
+        return url
+
+    def _load_cache(self) -> Dict[str, str]:
+        """读取本地缓存，文件不存在或损坏时返回空缓存"""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
         try:
-            with open(image_path, "rb") as file:
-                response = requests.post(
-                    "https://api.imgbb.com/1/upload",
-                    data={"key": self.api_key},
-                    files={"image": file}
-                )
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"警告: 图片缓存读取失败，将忽略: {str(e)}")
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+    def _save_url(self, digest: str, url: str) -> None:
+        """记录上传结果并写回本地缓存"""
+        with self._cache_lock:
+            self._url_cache[digest] = url
+            if not self.cache_path:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                tmp_path = f"{self.cache_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self._url_cache, f)
+                os.replace(tmp_path, self.cache_path)
+            except OSError as e:
+                print(f"警告: 图片缓存写入失败: {str(e)}")
+
+    def _upload(self, image_path: str, image_data: bytes) -> Optional[str]:
+        # 使用multipart直接发送原始字节；base64表单会让请求体膨胀约1/3
+        try:
+            response = self.session.post(
+                "https://api.imgbb.com/1/upload",
+                data={"key": self.api_key},
+                files={"image": (os.path.basename(image_path), image_data)}
+            )
             if response.ok:
                 return response.json()["data"]["url"]
             print(f"图片上传失败: {response.text}")
@@ -108,119 +262,221 @@ class NotionBlockFactory:
         }
 
 class MarkdownParser:
+    # 图片上传线程数
+    MAX_UPLOAD_WORKERS = 8
+    # 重复行(分隔符、固定标题等)的块缓存容量
+    BLOCK_CACHE_SIZE = 2048
+    # 解析与上传之间的队列容量
+    QUEUE_SIZE = 64
+    # 队列空闲超过该秒数时提交已攒下的块
+    FLUSH_INTERVAL = 0.5
+
     def __init__(self, notion_client: NotionClient, image_uploader: ImageUploader):
         self.notion_client = notion_client
         self.image_uploader = image_uploader
         self.block_factory = NotionBlockFactory()
+        # 相同 (kind, 文本) 复用同一个块；块构造后只读，仅用于序列化上传
+        self._cached_block = functools.lru_cache(maxsize=self.BLOCK_CACHE_SIZE)(self._build_block)
         
     def process_text_block(self, line: str) -> List[Dict[str, Any]]:
         """处理文本块,解析行内公式和加粗文本"""
+        # split 结果为 [文本, block, inline, bold, 文本, block, ...]
+        pieces = _INLINE_RE.split(line)
         parts = []
-        pattern = re.compile(r'(\$\$.*?\$\$|\$.*?\$|\*\*.*?\*\*)')
-        last_end = 0
-
-        for match in pattern.finditer(line):
-            if match.start() > last_end:
-                parts.append({
-                    "type": "text",
-                    "text": {"content": line[last_end:match.start()]}
-                })
+        if pieces[0]:
+            parts.append({"type": "text", "text": {"content": pieces[0]}})
 
-            content = match.group()
-            if content.startswith("$$") and content.endswith("$$"):
-                parts.append({
-                    "type": "text",
-                    "text": {"content": content}
-                })
-            elif content.startswith("$") and content.endswith("$"):
+        groups = iter(pieces)
+        next(groups)
+        for block, inline, bold, text in zip(groups, groups, groups, groups):
+            if inline is not None:
                 parts.append({
                     "type": "equation",
-                    "equation": {"expression": content[1:-1]}
-                })
-            elif content.startswith("**") and content.endswith("**"):
-                parts.append({
-                    "type": "text",
-                    "text": {"content": content[2:-2]},
-                    "annotations": {"bold": True}
+                    "equation": {"expression": inline}
                 })
-
-            last_end = match.end()
-
-        if last_end < len(line):
-            parts.append({
-                "type": "text",
-                "text": {"content": line[last_end:]}
-            })
+            elif bold is not None:
+                part = _BOLD_PART_TEMPLATE.copy()
+                part["text"] = {"content": bold}
+                parts.append(part)
+            else:
+                # 段落中的 $$...$$ 原样保留为文本
+                parts.append({"type": "text", "text": {"content": block}})
+            if text:
+                parts.append({"type": "text", "text": {"content": text}})
 
         return parts
 
+    def _build_block(self, kind: str, text: str) -> Dict[str, Any]:
+        """构造块，kind 为 "rich_text" 时解析行内格式，否则作为 block_type 创建纯文本块"""
+        if kind == "rich_text":
+            return self.block_factory.create_rich_text_block(self.process_text_block(text))
+        return self.block_factory.create_text_block(text, kind)
+
     def parse_and_upload(self, file_path: str) -> None:
-        """解析Markdown文件并上传到Notion"""
-        with open(file_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
+        """解析Markdown文件并上传到Notion
+
+        主线程解析并把 (kind, payload) 按顺序放入有界队列，后台线程取出后
+        批量创建块；本地图片在解析时即提交到线程池并发上传。
+        """
+        block_queue: "queue.Queue[Optional[Tuple[str, Any]]]" = queue.Queue(maxsize=self.QUEUE_SIZE)
+        abort = threading.Event()
+        errors: List[BaseException] = []
+        stats = {"failed": 0}
+        worker = threading.Thread(target=self._upload_worker,
+                                  args=(block_queue, abort, errors, stats), daemon=True)
+        worker.start()
+        executor = ThreadPoolExecutor(max_workers=self.MAX_UPLOAD_WORKERS)
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                for item in self._parse_lines(tqdm(f, desc="处理Markdown"), file_path,
+                                              executor):
+                    block_queue.put(item)
+        except BaseException:
+            # 解析出错或被中断(Ctrl-C)时不再写入Notion：取消排队中的图片上传，
+            # 后台线程丢弃尚未提交的块，只有正常读完文件才提交剩余的块
+            abort.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        else:
+            executor.shutdown()
+        finally:
+            block_queue.put(None)
+            worker.join()
+        if errors:
+            raise errors[0]
+        if stats["failed"]:
+            raise RuntimeError(f"共有 {stats['failed']} 个块创建失败，详见上方输出")
+
+    def _upload_worker(self, block_queue: "queue.Queue[Optional[Tuple[str, Any]]]",
+                       abort: threading.Event, errors: List[BaseException],
+                       stats: Dict[str, int]) -> None:
+        """消费解析结果，攒满一批或等待超时后提交到Notion，收到None时结束
+
+        abort 被设置后不再提交，丢弃已攒下和后续取到的块；
+        创建失败的块数量累加到 stats["failed"]。
+        """
+        pending: List[Dict[str, Any]] = []
+        done = False
+
+        def flush() -> None:
+            nonlocal pending
+            if not abort.is_set():
+                stats["failed"] += self.notion_client.create_blocks(pending)
+            pending = []
+
+        try:
+            while True:
+                try:
+                    item = block_queue.get(timeout=self.FLUSH_INTERVAL if pending else None)
+                except queue.Empty:
+                    flush()
+                    continue
+                if item is None:
+                    done = True
+                    break
+                if abort.is_set():
+                    pending = []
+                    continue
+
+                kind, payload = item
+                if kind == "image":
+                    alt_text, image_url = payload
+                    if isinstance(image_url, Future):
+                        image_url = self._wait_image(image_url, abort)
+                    if not image_url:
+                        continue
+                    pending.append(self.block_factory.create_image_block(image_url))
+                    if alt_text:
+                        pending.append(self._cached_block("paragraph", alt_text))
+                else:
+                    pending.append(payload)
+
+                if len(pending) >= NotionClient.MAX_BLOCKS_PER_REQUEST:
+                    flush()
+
+            if pending:
+                flush()
+        except Exception as e:
+            errors.append(e)
+            # 尚未收到结束标记时继续取空队列，避免解析线程阻塞在 put 上
+            while not done:
+                done = block_queue.get() is None
 
+    def _wait_image(self, future: "Future[Optional[str]]",
+                    abort: threading.Event) -> Optional[str]:
+        """等待图片上传结果，期间定期检查 abort，中止或已取消时返回None"""
+        while True:
+            try:
+                return future.result(timeout=self.FLUSH_INTERVAL)
+            except FutureTimeoutError:
+                if abort.is_set():
+                    return None
+            except CancelledError:
+                return None
+
+    def _parse_lines(self, lines: Iterable[str], file_path: str,
+                     executor: ThreadPoolExecutor) -> Iterator[Tuple[str, Any]]:
+        """逐行解析Markdown，按顺序产出 (kind, payload)；本地图片提交到 executor 上传"""
+        image_futures: Dict[str, "Future[Optional[str]]"] = {}
         current_equation = None
 
-        for line in tqdm(lines, desc="处理Markdown"):
+        for line in lines:
+            # 公式块内的行原样保留(含空行和缩进)，只去掉换行符
+            if current_equation is not None:
+                line = line.rstrip("\n")
+                if line.strip() == "$$":
+                    yield "block", self.block_factory.create_equation_block(
+                        current_equation.getvalue().rstrip("\n")
+                    )
+                    current_equation = None
+                else:
+                    current_equation.write(line)
+                    current_equation.write("\n")
+                continue
+
             line = line.strip()
             if not line:
                 continue
 
+            line_type, *fields = _classify(line)
+
             # 标题处理
-            if line.startswith(("# ", "## ", "### ")):
-                level = len(line.split()[0])  # 获取#的数量
-                self.notion_client.create_block(
-                    self.block_factory.create_text_block(
-                        line[level+1:], f"heading_{level}"
-                    )
-                )
+            if line_type == "heading":
+                yield "block", self._cached_block(*fields)
                 continue
 
-            # 块级数学公式处理
-            if line == "$$":
-                if current_equation is None:
-                    current_equation = []
-                else:
-                    self.notion_client.create_block(
-                        self.block_factory.create_equation_block("\n".join(current_equation))
-                    )
-                    current_equation = None
-                continue
-            
-            if current_equation is not None:
-                current_equation.append(line)
+            # 块级数学公式开始
+            if line_type == "equation_fence":
+                current_equation = io.StringIO()
                 continue
 
             # 图片处理
-            if match := re.match(r"!\[(.*?)\]\((.*?)\)", line):
-                alt_text, image_path = match.groups()
-                image_url = (image_path if image_path.startswith("http") else
-                           self._resolve_local_image(image_path, file_path))
-                
-                if image_url:
-                    self.notion_client.create_block(
-                        self.block_factory.create_image_block(image_url)
+            if line_type == "image":
+                alt_text, image_path = fields
+                if image_path.startswith("http"):
+                    yield "image", (alt_text, image_path)
+                    continue
+                image_path = self._locate_local_image(image_path, file_path)
+                if image_path is None:
+                    continue
+                if image_path not in image_futures:
+                    image_futures[image_path] = executor.submit(
+                        self.image_uploader.upload_to_imgbb, image_path
                     )
-                    if alt_text:
-                        self.notion_client.create_block(
-                            self.block_factory.create_text_block(alt_text)
-                        )
+                yield "image", (alt_text, image_futures[image_path])
                 continue
 
             # 普通段落处理
-            rich_text_parts = self.process_text_block(line)
-            self.notion_client.create_block(
-                self.block_factory.create_rich_text_block(rich_text_parts)
-            )
+            yield "block", self._cached_block("rich_text", line)
 
-    def _resolve_local_image(self, image_path: str, md_file_path: str) -> Optional[str]:
-        """解析本地图片路径并上传"""
+    def _locate_local_image(self, image_path: str, md_file_path: str) -> Optional[str]:
+        """解析本地图片路径，文件不存在时返回None"""
         if not os.path.exists(image_path):
             image_path = os.path.join(os.path.dirname(md_file_path), image_path)
         if not os.path.exists(image_path):
             print(f"警告: 图片文件不存在: {image_path}")
             return None
-        return self.image_uploader.upload_to_imgbb(image_path)
+        return image_path
 
 def main():
     parser = argparse.ArgumentParser(description="将Markdown文件转换并上传到Notion")
@@ -0,0 +1,150 @@
+import threading
+
+import pytest
+import requests
+
+from md_to_notion import ImageUploader, MarkdownParser, NotionClient
+
+
+class _Response:
+    def __init__(self, status_code=200, text=""):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = text
+
+
+class _RecordingSession:
+    """记录每次PATCH提交的块；含有 reject 文本的批次返回400，模拟 Notion 拒绝整批"""
+
+    def __init__(self, reject=None):
+        self.headers = {}
+        self.reject = reject
+        self.created = []
+
+    def patch(self, url, json):
+        children = json["children"]
+        if self.reject and any(self.reject in str(block) for block in children):
+            return _Response(400, "validation_error")
+        self.created.extend(children)
+        return _Response()
+
+
+def _make_parser(session):
+    notion_client = NotionClient("notion-key", "page-id")
+    notion_client.session = session
+    return MarkdownParser(notion_client, ImageUploader("imgbb-key", cache_path=None))
+
+
+def _paragraph_text(block):
+    return "".join(part["text"]["content"] for part in block["paragraph"]["rich_text"])
+
+
+class _LastFlushFailingSession:
+    """整批(100块)提交成功，最后不足一批的PATCH失败，模拟结束时提交出错"""
+
+    def __init__(self):
+        self.headers = {}
+
+    def patch(self, url, json):
+        if len(json["children"]) < NotionClient.MAX_BLOCKS_PER_REQUEST:
+            raise requests.ConnectionError("connection reset")
+        return _Response()
+
+
+@pytest.mark.parametrize("line_count", [2, 150])
+def test_parse_and_upload_raises_when_last_flush_fails(tmp_path, line_count):
+    md_file = tmp_path / "doc.md"
+    md_file.write_text("".join(f"第{i}行\n" for i in range(line_count)), encoding="utf-8")
+
+    parser = _make_parser(_LastFlushFailingSession())
+
+    errors = []
+
+    def run():
+        try:
+            parser.parse_and_upload(str(md_file))
+        except requests.ConnectionError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+
+    assert not thread.is_alive(), "parse_and_upload 在最后一批提交失败后卡住"
+    assert len(errors) == 1
+
+
+def test_rejected_block_only_drops_itself(tmp_path):
+    md_file = tmp_path / "doc.md"
+    lines = [f"第{i}行" for i in range(150)]
+    lines[42] = "无效块"
+    md_file.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    session = _RecordingSession(reject="无效块")
+    with pytest.raises(RuntimeError, match="1 个块创建失败"):
+        _make_parser(session).parse_and_upload(str(md_file))
+
+    assert [_paragraph_text(block) for block in session.created] == lines[:42] + lines[43:]
+
+
+def test_interrupt_during_parse_discards_pending_blocks(tmp_path):
+    md_file = tmp_path / "doc.md"
+    md_file.write_text("", encoding="utf-8")
+
+    session = _RecordingSession()
+    parser = _make_parser(session)
+    release = threading.Event()
+    futures = []
+
+    def interrupted_parse(lines, file_path, executor):
+        # 占满上传线程并多排队两个任务，中断后排队的任务应被取消
+        for _ in range(MarkdownParser.MAX_UPLOAD_WORKERS + 2):
+            futures.append(executor.submit(release.wait, 10))
+        for i in range(50):
+            yield "block", parser._cached_block("rich_text", f"第{i}行")
+        yield "image", ("", futures[0])
+        raise KeyboardInterrupt
+
+    parser._parse_lines = interrupted_parse
+    errors = []
+
+    def run():
+        try:
+            parser.parse_and_upload(str(md_file))
+        except KeyboardInterrupt as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    release.set()
+
+    assert not thread.is_alive(), "parse_and_upload 在中断后卡住"
+    assert len(errors) == 1
+    assert session.created == []
+    assert all(future.cancelled() for future in futures[MarkdownParser.MAX_UPLOAD_WORKERS:])
+
+
+def test_block_equation_keeps_lines_verbatim(tmp_path):
+    md_file = tmp_path / "doc.md"
+    md_file.write_text(
+        "$$\n"
+        "a = 1\n"
+        "\n"
+        "  b = 2\n"
+        "# 不是标题\n"
+        "\n"
+        "\n"
+        "  $$  \n"
+        "# 标题\n",
+        encoding="utf-8",
+    )
+
+    session = _RecordingSession()
+    _make_parser(session).parse_and_upload(str(md_file))
+
+    equation, heading = session.created
+    # 空行、缩进和 # 行原样保留；块末尾的空行被去掉
+    assert equation["equation"]["expression"] == "a = 1\n\n  b = 2\n# 不是标题"
+    assert heading["type"] == "heading_1"
+    assert heading["heading_1"]["rich_text"][0]["text"]["content"] == "标题"